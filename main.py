@@ -10,18 +10,29 @@ Notes:
 """
 
 import os
-import json
-import sqlite3
+import asyncio
+import hashlib
 import logging
-from datetime import datetime
+import pathlib
+import sqlite3
+import time
+from contextlib import asynccontextmanager
 from typing import Optional
 
-import requests
-from telegram import Update, constants
+import aiosqlite
+import diskcache
+import httpx
+import orjson
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, constants
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
-    CommandHandler,
+    CallbackQueryHandler,
     ContextTypes,
+    MessageHandler,
+    filters,
 )
 
 # --- Config + logging ---
@@ -31,6 +42,14 @@ logger = logging.getLogger(__name__)
 TELEGRAM_BOT_TOKEN: Optional[str] = os.getenv("TELEGRAM_BOT_TOKEN")
 LEAKOSINT_API_TOKEN: Optional[str] = os.getenv("LEAKOSINT_API_TOKEN")
 LEAKOSINT_API_URL: str = os.getenv("LEAKOSINT_API_URL", "https://leakosintapi.com/")
+LEAKOSINT_CACHE_DIR: str = os.getenv("LEAKOSINT_CACHE_DIR", "/tmp/leakosint_cache")
+LEAKOSINT_CACHE_TTL: int = int(os.getenv("LEAKOSINT_CACHE_TTL", "3600"))
+# Retries per LeakOSINT request, for both failed connects (nothing was sent, so
+# always safe) and 502/503/504 responses. A 502/504 can arrive after the
+# upstream already ran -- and billed -- the search, so a retried search may be
+# charged twice; set this to 0 to never repeat a request that reached the API.
+LEAKOSINT_MAX_RETRIES: int = int(os.getenv("LEAKOSINT_MAX_RETRIES", "2"))
+LEAKOSINT_MAX_RESPONSE_BYTES: int = int(os.getenv("LEAKOSINT_MAX_RESPONSE_BYTES", str(8 << 20)))
 WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/webhook")
 PORT: int = int(os.getenv("PORT", "10000"))
 ADMIN_IDS = set(int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip())
@@ -39,9 +58,20 @@ RENDER_EXTERNAL_URL: Optional[str] = os.getenv("RENDER_EXTERNAL_URL") or os.gete
 TELEGRAM_WEBHOOK_SECRET_TOKEN: Optional[str] = os.getenv("TELEGRAM_WEBHOOK_SECRET_TOKEN")
 
 DB_PATH: str = os.getenv("DB_PATH", "bot.db")
+DB_READ_POOL_SIZE: int = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+# Seconds the batched writer waits for more blind writes before committing.
+WRITE_BATCH_WINDOW: float = float(os.getenv("WRITE_BATCH_WINDOW", "0.02"))
 COIN_COST_PER_SEARCH: int = int(os.getenv("COIN_COST_PER_SEARCH", "1"))
 NEW_USER_COINS: int = int(os.getenv("NEW_USER_COINS", "1"))
 REFERRAL_REWARD: int = int(os.getenv("REFERRAL_REWARD", "1"))
+# Long search results are split over at most this many messages.
+SEARCH_MAX_MESSAGES: int = int(os.getenv("SEARCH_MAX_MESSAGES", "3"))
+SEARCH_MAX_RECORDS: int = int(os.getenv("SEARCH_MAX_RECORDS", "10"))
+# Minimum seconds between two /search calls from the same (non-admin) user.
+SEARCH_MIN_INTERVAL: float = float(os.getenv("SEARCH_MIN_INTERVAL", "3"))
+# Telegram allows ~30 messages/s per bot overall; stay a little under it.
+BROADCAST_RATE_PER_SEC: int = int(os.getenv("BROADCAST_RATE_PER_SEC", "25"))
+BROADCAST_MAX_RETRIES: int = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
 
 # Validate minimal config
 if not TELEGRAM_BOT_TOKEN:
@@ -54,10 +84,78 @@ if not RENDER_EXTERNAL_URL:
     logger.warning("RENDER_EXTERNAL_URL / BASE_URL not set. You must set it so webhook can be configured automatically.")
 
 # --- DB helpers ---
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.executescript("""
+# One long-lived read-write aiosqlite connection (_DB) plus a small pool of
+# read-only ones, all opened by init_db() from post_init so they bind to the
+# loop run_webhook() drives. aiosqlite runs sqlite on a worker thread per
+# connection, so handlers awaiting a query leave the event loop free to serve
+# other webhook updates, and plain reads never queue behind the writer's
+# thread: under WAL they just read the last committed snapshot.
+# isolation_level=None puts the writer in autocommit mode; multi-statement
+# writes open their own transaction via _write_txn(), and the lock keeps
+# concurrently dispatched handlers from interleaving statements inside someone
+# else's transaction.
+_DB: Optional[aiosqlite.Connection] = None
+_WRITE_LOCK = asyncio.Lock()
+_READ_POOL: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+
+# Statement text lives in module constants so every call site hands sqlite the
+# exact same string and hits the connection's prepared-statement cache
+# (cached_statements below) instead of re-parsing and re-planning SQL.
+USER_COLS = "telegram_id,username,referral_code,referred_by,coins,created_at"
+SQL_USER_BY = {col: f"SELECT {USER_COLS} FROM users WHERE {col}=?" for col in ("telegram_id", "username")}
+SQL_USER_EXISTS = "SELECT 1 FROM users WHERE telegram_id=?"
+# /users pages newest-first with a (created_at, id) keyset cursor.
+SQL_LIST_USERS = f"SELECT {USER_COLS},id FROM users ORDER BY created_at DESC, id DESC LIMIT ?"
+SQL_LIST_USERS_BEFORE = (f"SELECT {USER_COLS},id FROM users WHERE (created_at, id) < (?, ?) "
+                         "ORDER BY created_at DESC, id DESC LIMIT ?")
+SQL_USER_IDS_AFTER = "SELECT telegram_id FROM users WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?"
+SQL_GET_BALANCE = "SELECT coins FROM users WHERE telegram_id=?"
+SQL_GET_STATS = "SELECT total_users, total_coins FROM stats WHERE id=1"
+SQL_INSERT_USER = ("INSERT INTO users (telegram_id, username, referral_code, coins) VALUES (?, ?, ?, ?) "
+                   "ON CONFLICT(telegram_id) DO NOTHING RETURNING id")
+SQL_REFERRER_BY_CODE = "SELECT telegram_id FROM users WHERE referral_code=? AND telegram_id!=?"
+SQL_SET_REFERRER = "UPDATE users SET referred_by=? WHERE telegram_id=? AND referred_by IS NULL"
+SQL_ADD_COINS = "UPDATE users SET coins = coins + ? WHERE telegram_id=? RETURNING coins"
+SQL_ADD_COINS_PAIR = "UPDATE users SET coins = coins + ? WHERE telegram_id IN (?, ?)"
+SQL_SET_COINS = "UPDATE users SET coins = ? WHERE telegram_id=? RETURNING coins"
+SQL_DEDUCT_COINS = "UPDATE users SET coins = coins - ? WHERE telegram_id=? AND coins >= ? RETURNING coins"
+SQL_INSERT_TX = "INSERT INTO transactions (telegram_id, kind, amount, note) VALUES (?, ?, ?, ?)"
+
+# created_at is filled in by sqlite itself rather than formatted in Python on
+# every write.
+_NOW_ISO = "(strftime('%Y-%m-%dT%H:%M:%fZ','now'))"
+SQL_SYNC_STATS = (
+    "INSERT INTO stats (id, total_users, total_coins) "
+    "SELECT 1, COUNT(*), COALESCE(SUM(coins), 0) FROM users WHERE true "
+    "ON CONFLICT(id) DO UPDATE SET total_users = excluded.total_users, "
+    "total_coins = excluded.total_coins"
+)
+# The single-row stats table is kept in step with users by triggers, so /stats
+# never has to COUNT/SUM over users and no write path can forget a delta.
+STATS_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users BEGIN
+    UPDATE stats SET total_users = total_users + 1,
+                     total_coins = total_coins + COALESCE(NEW.coins, 0) WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS stats_users_coins AFTER UPDATE OF coins ON users
+WHEN NEW.coins IS NOT OLD.coins BEGIN
+    UPDATE stats SET total_coins = total_coins + COALESCE(NEW.coins, 0) - COALESCE(OLD.coins, 0) WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users BEGIN
+    UPDATE stats SET total_users = total_users - 1,
+                     total_coins = total_coins - COALESCE(OLD.coins, 0) WHERE id = 1;
+END;
+"""
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
+CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_tx_tg_created ON transactions(telegram_id, created_at DESC);
+DROP INDEX IF EXISTS idx_tx_tg;
+"""
+SQL_HAS_STAT1 = "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+
+TABLES = {
+    "users": f"""
     CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY,
         telegram_id INTEGER UNIQUE,
@@ -65,133 +163,450 @@ def init_db():
         referral_code TEXT UNIQUE,
         referred_by INTEGER,
         coins INTEGER DEFAULT 0,
-        created_at TEXT
-    );
+        created_at TEXT NOT NULL DEFAULT {_NOW_ISO}
+    )""",
+    "transactions": f"""
     CREATE TABLE IF NOT EXISTS transactions (
         id INTEGER PRIMARY KEY,
         telegram_id INTEGER,
         kind TEXT,
         amount INTEGER,
         note TEXT,
-        created_at TEXT
-    );
-    """)
-    conn.commit()
-    conn.close()
-    logger.info("DB initialized / ensured tables exist")
+        created_at TEXT NOT NULL DEFAULT {_NOW_ISO}
+    )""",
+    "stats": """
+    CREATE TABLE IF NOT EXISTS stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_users INTEGER NOT NULL,
+        total_coins INTEGER NOT NULL
+    )""",
+}
+
+async def _migrate_created_at_default(table):
+    """Rebuild a table created before created_at had a DEFAULT (sqlite can't
+    ALTER a column default in place)."""
+    async with _DB.execute(f"PRAGMA table_info({table})") as cur:
+        cols = await cur.fetchall()
+    if next(c["dflt_value"] for c in cols if c["name"] == "created_at") is not None:
+        return
+    names = ", ".join(c["name"] for c in cols)
+    select = ", ".join(f"COALESCE(created_at, {_NOW_ISO})" if c["name"] == "created_at" else c["name"] for c in cols)
+    async with _write_txn() as db:
+        await db.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+        await db.execute(TABLES[table])
+        await db.execute(f"INSERT INTO {table} ({names}) SELECT {select} FROM {table}_old")
+        await db.execute(f"DROP TABLE {table}_old")
+    logger.info("Migrated %s.created_at to a column default", table)
+
+# journal_mode is a property of the database file and only needs setting once;
+# the rest are per connection, so every connection we open gets them.
+_CONN_PRAGMAS = """
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+PRAGMA cache_size=-64000;
+PRAGMA busy_timeout=5000;
+"""
+
+async def _connect(database, **kwargs):
+    conn = await aiosqlite.connect(database, cached_statements=256, **kwargs)
+    conn.row_factory = sqlite3.Row
+    await conn.executescript(_CONN_PRAGMAS)
+    return conn
+
+async def init_db():
+    global _DB
+    _DB = await _connect(DB_PATH, isolation_level=None)
+    await _DB.execute("PRAGMA journal_mode=WAL")
+    await _DB.execute("PRAGMA wal_autocheckpoint=1000")
+    # Caps how many rows ANALYZE / PRAGMA optimize sample per index, so they
+    # stay quick (they run under the write lock) however large the tables get.
+    await _DB.execute("PRAGMA analysis_limit=400")
+    for table, ddl in TABLES.items():
+        await _DB.execute(ddl)
+        if table != "stats":
+            await _migrate_created_at_default(table)
+    # One aggregate pass at boot seeds the counters (and re-syncs them after any
+    # change made while the triggers didn't exist); triggers take it from there.
+    await _DB.execute(SQL_SYNC_STATS)
+    await _DB.executescript(STATS_TRIGGERS)
+    await _DB.executescript(INDEXES)
+    # Gives the planner row statistics once; sqlite_stat1 persists afterwards.
+    if not await (await _DB.execute(SQL_HAS_STAT1)).fetchone():
+        await _DB.execute("ANALYZE")
+    read_uri = pathlib.Path(DB_PATH).resolve().as_uri() + "?mode=ro"
+    for _ in range(DB_READ_POOL_SIZE):
+        _READ_POOL.put_nowait(await _connect(read_uri, uri=True))
+    _KNOWN_IDS.clear()
+    _KNOWN_IDS.update([tg_id async for tg_id in iter_user_ids()])
+    logger.info("DB initialized / ensured tables exist (%d users)", len(_KNOWN_IDS))
 
-def get_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+async def close_db():
+    global _DB
+    while not _READ_POOL.empty():
+        await _READ_POOL.get_nowait().close()
+    if _DB is not None:
+        # Let a scheduled optimize finish before the writer goes away; its
+        # failures are already logged by the task's done-callback.
+        if _optimize_task is not None and not _optimize_task.done():
+            await asyncio.wait([_optimize_task])
+        await _DB.execute("PRAGMA optimize")
+        await _DB.close()
+        _DB = None
+
+@asynccontextmanager
+async def _write_txn():
+    """Run the enclosed statements in one locked BEGIN IMMEDIATE ... COMMIT."""
+    async with _WRITE_LOCK:
+        await _DB.execute("BEGIN IMMEDIATE")
+        try:
+            yield _DB
+            await _DB.execute("COMMIT")
+        except BaseException:
+            # Also covers a failed COMMIT (BUSY/FULL/IOERR): leaving the
+            # connection mid-transaction would break every later BEGIN.
+            if _DB.in_transaction:
+                await _DB.execute("ROLLBACK")
+            raise
+
+# --- Batched writer ---
+# Blind mutations (ones whose caller needs no result back from sqlite) are not
+# committed by the handler itself. They are queued and a single writer task
+# coalesces everything that arrives within WRITE_BATCH_WINDOW into one
+# transaction, so a burst of updates shares one commit instead of paying one
+# each. Statements with the same SQL text are run together via executemany,
+# which reorders them relative to statements with *different* SQL: only queue
+# statements that commute with each other (relative UPDATEs, ledger INSERTs).
+# Writes that are conditional, absolute, or report the new balance back
+# (onboard_user, award_coins, set_coins) run in their own _write_txn();
+# deduct_coins' debit is a single autocommit UPDATE under _WRITE_LOCK, and its
+# ledger row is currently the only thing queued here. Reads stay direct and
+# never wait on the writer.
+_WRITE_QUEUE: "asyncio.Queue[Optional[tuple[list, asyncio.Future]]]" = asyncio.Queue()
+_WRITER_TASK: Optional[asyncio.Task] = None
+
+def _queue_write(*statements):
+    """Queue one atomic group of (sql, params) statements; the returned future
+    resolves once the batch holding them is committed."""
+    fut = asyncio.get_running_loop().create_future()
+    _WRITE_QUEUE.put_nowait((list(statements), fut))
+    return fut
+
+def _defer_write(*statements):
+    """Fire-and-forget _queue_write() for rows nobody waits on (ledger entries)."""
+    _queue_write(*statements).add_done_callback(_log_deferred_failure)
+
+def _log_deferred_failure(fut):
+    if not fut.cancelled() and fut.exception() is not None:
+        logger.error("Deferred write failed: %s", fut.exception())
+
+async def _commit_batch(batch):
+    grouped = {}
+    for statements, _ in batch:
+        for sql, params in statements:
+            grouped.setdefault(sql, []).append(params)
+    async with _write_txn() as db:
+        for sql, params_list in grouped.items():
+            await db.executemany(sql, params_list)
+
+async def _flush_writes(batch):
+    try:
+        await _commit_batch(batch)
+    except Exception as e:
+        if len(batch) == 1:
+            batch[0][1].set_exception(e)
+            return
+        # One bad group must not take the rest of the batch down with it:
+        # replay each group in its own transaction and fail only its caller.
+        logger.exception("Batched write failed; retrying %d group(s) one by one", len(batch))
+        for item in batch:
+            try:
+                await _commit_batch([item])
+            except Exception as e:
+                if not item[1].done():
+                    item[1].set_exception(e)
+            else:
+                if not item[1].done():
+                    item[1].set_result(None)
+        return
+    for _, fut in batch:
+        if not fut.done():
+            fut.set_result(None)
+
+async def _writer_loop():
+    while True:
+        item = await _WRITE_QUEUE.get()
+        if item is None:
+            return
+        batch = [item]
+        await asyncio.sleep(WRITE_BATCH_WINDOW)
+        stopping = False
+        while not _WRITE_QUEUE.empty():
+            item = _WRITE_QUEUE.get_nowait()
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+        await _flush_writes(batch)
+        if stopping:
+            return
+
+def start_writer():
+    global _WRITER_TASK
+    _WRITER_TASK = asyncio.get_running_loop().create_task(_writer_loop())
+
+async def stop_writer():
+    """Let the writer commit what it already holds, then flush any stragglers.
+
+    Stopping via a sentinel rather than cancel(): cancelling mid-batch would
+    roll back writes whose callers were already told they succeeded.
+    """
+    global _WRITER_TASK
+    if _WRITER_TASK is not None:
+        _WRITE_QUEUE.put_nowait(None)
+        await _WRITER_TASK
+        _WRITER_TASK = None
+    batch = []
+    while not _WRITE_QUEUE.empty():
+        item = _WRITE_QUEUE.get_nowait()
+        if item is not None:
+            batch.append(item)
+    if batch:
+        await _flush_writes(batch)
+
+# Planner statistics go stale as the tables grow, so every OPTIMIZE_EVERY
+# reader checkouts the writer runs PRAGMA optimize, which re-ANALYZEs only the
+# tables that need it. The readers are read-only and can't store statistics.
+OPTIMIZE_EVERY = 1024
+_reads_since_optimize = 0
+_optimize_task: Optional[asyncio.Task] = None
+
+async def _optimize_db():
+    async with _WRITE_LOCK:
+        await _DB.execute("PRAGMA optimize")
+
+def _log_optimize_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("PRAGMA optimize failed: %s", task.exception())
+
+@asynccontextmanager
+async def _borrow_reader():
+    """Check a warm read-only connection out of the pool for the block."""
+    global _reads_since_optimize, _optimize_task
+    conn = await _READ_POOL.get()
+    try:
+        yield conn
+    finally:
+        _READ_POOL.put_nowait(conn)
+        _reads_since_optimize += 1
+        if (_reads_since_optimize >= OPTIMIZE_EVERY and _DB is not None
+                and (_optimize_task is None or _optimize_task.done())):
+            _reads_since_optimize = 0
+            _optimize_task = asyncio.get_running_loop().create_task(_optimize_db())
+            _optimize_task.add_done_callback(_log_optimize_failure)
+
+async def _read(sql, params=(), one=False):
+    """Run a read-only query on a pooled reader connection."""
+    async with _borrow_reader() as conn:
+        async with conn.execute(sql, params) as cur:
+            return await (cur.fetchone() if one else cur.fetchall())
+
+async def _fetchone(sql, params=()):
+    return await _read(sql, params, one=True)
+
+# Short-lived read caches for the per-user hot paths (/balance, /referral).
+# Every write that touches a user's row drops that user's entries; the TTL only
+# bounds how long an entry can outlive a change made outside this process.
+# A read that was in flight across a write must not store its (now stale)
+# result, so writes also bump one global write generation and readers only fill
+# the cache if it is unchanged since before their query. A write to some other
+# user merely skips one fill; in exchange the guard costs a single int.
+_USER_CACHE = TTLCache(maxsize=10_000, ttl=30)
+_BALANCE_CACHE = TTLCache(maxsize=10_000, ttl=30)
+_WRITE_GEN = 0
+
+# Every telegram_id known to have a users row, loaded in init_db(). Lets
+# onboard_user(), which runs on every /start, skip sqlite for returning users.
+_KNOWN_IDS: set = set()
+
+def _invalidate_user(tg_id):
+    global _WRITE_GEN
+    _WRITE_GEN += 1
+    _USER_CACHE.pop(tg_id, None)
+    _BALANCE_CACHE.pop(tg_id, None)
+
+async def _fetch_user(where, param):
+    return await _fetchone(SQL_USER_BY[where], (param,))
 
 def generate_referral_code(tg_id):
     return f"r{tg_id}"
 
-def get_user_by_tg(tg_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id,username,referral_code,referred_by,coins,created_at FROM users WHERE telegram_id=?", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
+async def get_user_by_tg(tg_id):
+    if tg_id in _USER_CACHE:
+        return _USER_CACHE[tg_id]
+    gen = _WRITE_GEN
+    row = await _fetch_user("telegram_id", tg_id)
+    if _WRITE_GEN == gen:
+        _USER_CACHE[tg_id] = row
     return row
 
-def get_user_by_refcode(code):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id,username,referral_code,referred_by,coins,created_at FROM users WHERE referral_code=?", (code,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+async def get_user_by_identifier(identifier):
+    try:
+        tg_id = int(identifier)
+    except ValueError:
+        return await _fetch_user("username", identifier.lstrip("@"))
+    return await _fetch_user("telegram_id", tg_id)
 
-def get_user_by_identifier(identifier):
-    conn = get_conn()
-    cur = conn.cursor()
-    if identifier.isdigit():
-        cur.execute("SELECT telegram_id,username,referral_code,referred_by,coins,created_at FROM users WHERE telegram_id=?", (int(identifier),))
-    else:
-        uname = identifier.lstrip("@")
-        cur.execute("SELECT telegram_id,username,referral_code,referred_by,coins,created_at FROM users WHERE username=?", (uname,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+async def onboard_user(tg_user, ref_code=None):
+    """Create tg_user's row if it's missing and apply ref_code, all in one
+    transaction (so one commit per /start, referral or not).
 
-def ensure_user(tg_user):
+    A referral only applies while the user has no referrer yet and never to
+    the code's own owner. Returns (created, referrer_tg_id or None).
+    """
     tg_id = tg_user.id
+    if tg_id in _KNOWN_IDS and not ref_code:
+        return False, None
     username = tg_user.username or f"user{tg_id}"
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id FROM users WHERE telegram_id=?", (tg_id,))
-    if cur.fetchone():
-        conn.close()
-        return False
-    refcode = generate_referral_code(tg_id)
-    created_at = datetime.utcnow().isoformat()
-    cur.execute("INSERT INTO users (telegram_id, username, referral_code, coins, created_at) VALUES (?, ?, ?, ?, ?)",
-                (tg_id, username, refcode, NEW_USER_COINS, created_at))
-    cur.execute("INSERT INTO transactions (telegram_id, kind, amount, note, created_at) VALUES (?, ?, ?, ?, ?)",
-                (tg_id, 'reward', NEW_USER_COINS, 'new_user_bonus', created_at))
-    conn.commit()
-    conn.close()
-    logger.info("Created new user %s (%s) with %d coins", username, tg_id, NEW_USER_COINS)
-    return True
-
-def award_coins(tg_id, amount, kind="admin_adjust", note=""):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET coins = coins + ? WHERE telegram_id=?", (amount, tg_id))
-    cur.execute("INSERT INTO transactions (telegram_id, kind, amount, note, created_at) VALUES (?, ?, ?, ?, ?)",
-                (tg_id, kind, amount, note, datetime.utcnow().isoformat()))
-    conn.commit()
-    conn.close()
+    created = False
+    ref_tg_id = None
+    async with _write_txn() as db:
+        if tg_id not in _KNOWN_IDS:
+            # The upsert only returns a row when it actually inserted one, which
+            # replaces the separate existence SELECT.
+            async with db.execute(SQL_INSERT_USER, (tg_id, username, generate_referral_code(tg_id), NEW_USER_COINS)) as cur:
+                created = await cur.fetchone() is not None
+            if created:
+                await db.execute(SQL_INSERT_TX, (tg_id, 'reward', NEW_USER_COINS, 'new_user_bonus'))
+        if ref_code:
+            async with db.execute(SQL_REFERRER_BY_CODE, (ref_code, tg_id)) as cur:
+                refrow = await cur.fetchone()
+            if refrow is not None:
+                cur = await db.execute(SQL_SET_REFERRER, (refrow["telegram_id"], tg_id))
+                if cur.rowcount == 1:
+                    ref_tg_id = refrow["telegram_id"]
+                    await db.execute(SQL_ADD_COINS_PAIR, (REFERRAL_REWARD, ref_tg_id, tg_id))
+                    await db.executemany(SQL_INSERT_TX, [
+                        (ref_tg_id, "referral", REFERRAL_REWARD, f"referred {tg_id}"),
+                        (tg_id, "referral", REFERRAL_REWARD, f"referred_by {ref_tg_id}"),
+                    ])
+    _KNOWN_IDS.add(tg_id)
+    if created:
+        _invalidate_user(tg_id)
+        logger.info("Created new user %s (%s) with %d coins", username, tg_id, NEW_USER_COINS)
+    if ref_tg_id is not None:
+        _invalidate_user(ref_tg_id)
+        _invalidate_user(tg_id)
+        logger.info("Referral: %s referred %s (+%d each)", ref_tg_id, tg_id, REFERRAL_REWARD)
+    return created, ref_tg_id
+
+async def _adjust_coins(sql, params, ledger_row):
+    """Apply one balance UPDATE ... RETURNING plus its ledger row; returns the
+    new balance, or None (and writes nothing) if the user doesn't exist."""
+    async with _write_txn() as db:
+        async with db.execute(sql, params) as cur:
+            row = await cur.fetchone()
+        if row is not None:
+            await db.execute(SQL_INSERT_TX, ledger_row)
+    return row["coins"] if row else None
+
+async def award_coins(tg_id, amount, kind="admin_adjust", note=""):
+    balance = await _adjust_coins(SQL_ADD_COINS, (amount, tg_id), (tg_id, kind, amount, note))
+    _invalidate_user(tg_id)
     logger.info("Awarded %d coins to %s (%s)", amount, tg_id, kind)
+    return balance
 
-def set_coins(tg_id, amount):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET coins = ? WHERE telegram_id=?", (amount, tg_id))
-    cur.execute("INSERT INTO transactions (telegram_id, kind, amount, note, created_at) VALUES (?, ?, ?, ?, ?)",
-                (tg_id, 'admin_set', amount, 'admin_set_coins', datetime.utcnow().isoformat()))
-    conn.commit()
-    conn.close()
+async def set_coins(tg_id, amount):
+    balance = await _adjust_coins(SQL_SET_COINS, (amount, tg_id), (tg_id, 'admin_set', amount, 'admin_set_coins'))
+    _invalidate_user(tg_id)
     logger.info("Set coins for %s to %d", tg_id, amount)
+    return balance
 
-def deduct_coins(tg_id, amount):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT coins FROM users WHERE telegram_id=?", (tg_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return False, "user_not_found"
-    coins = row[0]
-    if coins < amount:
-        conn.close()
-        return False, "insufficient"
-    cur.execute("UPDATE users SET coins = coins - ? WHERE telegram_id=?", (amount, tg_id))
-    cur.execute("INSERT INTO transactions (telegram_id, kind, amount, note, created_at) VALUES (?, ?, ?, ?, ?)",
-                (tg_id, 'search', -amount, 'osint_search', datetime.utcnow().isoformat()))
-    conn.commit()
-    conn.close()
+async def deduct_coins(tg_id, amount):
+    # Check and debit in one conditional UPDATE: no read-check-write window in
+    # which two concurrent searches could both pass the balance check. It is a
+    # single autocommit statement, so no BEGIN/COMMIT; the lock only keeps it
+    # out of a batch the writer has open. The ledger row is left to the writer.
+    async with _WRITE_LOCK:
+        async with _DB.execute(SQL_DEDUCT_COINS, (amount, tg_id, amount)) as cur:
+            row = await cur.fetchone()
+        if row is not None:
+            # RETURNING already told us the new balance, so seed the cache
+            # instead of leaving it empty. Bumping the generation first stops
+            # a get_balance() that started before this debit from overwriting
+            # the seed with the old balance; seeding under the lock orders it
+            # before any later writer's invalidation.
+            _invalidate_user(tg_id)
+            _BALANCE_CACHE[tg_id] = row["coins"]
+    if row is None:
+        exists = await _fetchone(SQL_USER_EXISTS, (tg_id,))
+        return False, ("insufficient" if exists else "user_not_found")
+    _defer_write((SQL_INSERT_TX, (tg_id, 'search', -amount, 'osint_search')))
     logger.info("Deducted %d coins from %s", amount, tg_id)
     return True, None
 
-def get_balance(tg_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT coins FROM users WHERE telegram_id=?", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else 0
-
-def list_users(limit=100):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id,username,referral_code,referred_by,coins,created_at FROM users ORDER BY created_at DESC LIMIT ?", (limit,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+async def get_balance(tg_id):
+    if tg_id in _BALANCE_CACHE:
+        return _BALANCE_CACHE[tg_id]
+    gen = _WRITE_GEN
+    row = await _fetchone(SQL_GET_BALANCE, (tg_id,))
+    balance = row["coins"] if row else 0
+    if _WRITE_GEN == gen:
+        _BALANCE_CACHE[tg_id] = balance
+    return balance
+
+async def list_users(limit=100, before=None):
+    """Newest users first; before is the (created_at, id) of the last row seen."""
+    if before is None:
+        return await _read(SQL_LIST_USERS, (limit,))
+    return await _read(SQL_LIST_USERS_BEFORE, (*before, limit))
+
+async def iter_user_ids(page_size=500):
+    """Yield every telegram_id, one keyset page at a time.
+
+    Each page is its own short statement, so a long broadcast never keeps a
+    cursor open on the shared connection (which would pin a WAL snapshot and
+    stall checkpoints for the duration).
+    """
+    last = -1 << 63
+    while True:
+        rows = await _read(SQL_USER_IDS_AFTER, (last, page_size))
+        if not rows:
+            return
+        for row in rows:
+            yield row["telegram_id"]
+        last = rows[-1]["telegram_id"]
 
 # --- LeakOSINT query helper ---
-def query_leakosint(query: str):
+# One keep-alive HTTP/2 client for every search, so the TCP+TLS handshake to the
+# API is paid once rather than per /search; closed from post_shutdown. The
+# transport retries failed connects and query_leakosint retries gateway errors
+# with a short backoff, both up to LEAKOSINT_MAX_RETRIES times.
+_HTTP = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=LEAKOSINT_MAX_RETRIES,
+        limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+    ),
+    timeout=30,
+    headers={"Content-Type": "application/json"},
+)
+_RETRY_STATUSES = frozenset({502, 503, 504})
+
+async def _read_capped(r: httpx.Response) -> bytes:
+    """Read a streamed body, giving up as soon as it passes
+    LEAKOSINT_MAX_RESPONSE_BYTES instead of buffering all of it first."""
+    declared = r.headers.get("Content-Length")
+    if declared and int(declared) > LEAKOSINT_MAX_RESPONSE_BYTES:
+        raise ValueError(f"response too large ({declared} bytes)")
+    buf = bytearray()
+    async for chunk in r.aiter_bytes():
+        buf += chunk
+        if len(buf) > LEAKOSINT_MAX_RESPONSE_BYTES:
+            raise ValueError(f"response exceeds {LEAKOSINT_MAX_RESPONSE_BYTES} bytes")
+    return bytes(buf)
+
+async def query_leakosint(query: str):
     payload = {
         "token": LEAKOSINT_API_TOKEN,
         "request": query,
@@ -200,38 +615,127 @@ def query_leakosint(query: str):
         "type": "json",
     }
     try:
-        r = requests.post(LEAKOSINT_API_URL, json=payload, timeout=30)
-        r.raise_for_status()
-        return r.json()
+        body = orjson.dumps(payload)
+        for attempt in range(LEAKOSINT_MAX_RETRIES + 1):
+            async with _HTTP.stream("POST", LEAKOSINT_API_URL, content=body) as r:
+                if r.status_code not in _RETRY_STATUSES or attempt == LEAKOSINT_MAX_RETRIES:
+                    r.raise_for_status()
+                    return orjson.loads(await _read_capped(r))
+            await asyncio.sleep(0.3 * 2 ** attempt)
     except Exception as e:
         logger.exception("LeakOSINT query failed")
         return {"error": str(e)}
 
+# Responses are cached on disk keyed by the normalised query, so repeat searches
+# for the same phone/email skip the API round trip and don't spend API quota.
+# Error responses -- our own {"error": ...} and LeakOSINT's in-band
+# {"Error code": ...} (bad token, quota, rate limit) -- are never cached, so a
+# transient failure isn't served (and charged for) on every repeat search.
+# diskcache is blocking SQLite I/O, so its reads and writes run in a worker
+# thread to keep the event loop free.
+_RESP_CACHE = diskcache.Cache(LEAKOSINT_CACHE_DIR, size_limit=200_000_000)
+
+def _query_cache_key(query: str) -> str:
+    return hashlib.sha1(query.strip().lower().encode()).hexdigest()
+
+# A small in-memory layer in front of the disk cache serves hot queries without
+# touching disk, and concurrent misses for the same key share one lookup task.
+_HOT_RESULTS = TTLCache(maxsize=1024, ttl=300)
+_PENDING_QUERIES: dict[str, asyncio.Task] = {}
+_ERROR_KEYS = ("error", "Error code")
+
+async def _lookup_query(query: str, key: str):
+    cached = await asyncio.to_thread(_RESP_CACHE.get, key)
+    if cached is None:
+        cached = await query_leakosint(query)
+        if isinstance(cached, dict) and any(k in cached for k in _ERROR_KEYS):
+            return cached
+        await asyncio.to_thread(_RESP_CACHE.set, key, cached, expire=LEAKOSINT_CACHE_TTL)
+    _HOT_RESULTS[key] = cached
+    return cached
+
+async def cached_query_leakosint(query: str):
+    key = _query_cache_key(query)
+    hit = _HOT_RESULTS.get(key)
+    if hit is not None:
+        return hit
+    task = _PENDING_QUERIES.get(key)
+    if task is None:
+        task = asyncio.create_task(_lookup_query(query, key))
+        _PENDING_QUERIES[key] = task
+        task.add_done_callback(lambda _: _PENDING_QUERIES.pop(key, None))
+    # Shielded so one cancelled caller doesn't abort the lookup for the others.
+    return await asyncio.shield(task)
+
+# --- Search result rendering ---
+# Telegram caps a message at 4096 chars; keep chunks comfortably under it.
+SEARCH_MESSAGE_BUDGET = 3800
+
+def _dumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+def _result_pieces(result):
+    """Yield the result as separately serialized pieces: the top-level scalars
+    (counts, price, error) first, then one piece per entry of each nested dict
+    (LeakOSINT puts one entry per leaked database under "List")."""
+    if not isinstance(result, dict):
+        yield _dumps(result)
+        return
+    produced = False
+    scalars = {k: v for k, v in result.items() if not isinstance(v, dict)}
+    if scalars:
+        produced = True
+        yield _dumps(scalars)
+    for key, value in result.items():
+        if isinstance(value, dict):
+            for sub, subvalue in value.items():
+                produced = True
+                yield f"{key} / {sub}:\n{_dumps(_trim_records(subvalue))}"
+    # An empty result (or only empty nested dicts) still gets an answer.
+    if not produced:
+        yield _dumps(result)
+
+def _trim_records(db, limit=SEARCH_MAX_RECORDS):
+    """Cap a database entry's "Data" list before it is serialized; a limit=100
+    response can carry far more rows than the chat output will ever show."""
+    data = db.get("Data") if isinstance(db, dict) else None
+    if not isinstance(data, list) or len(data) <= limit:
+        return db
+    return {**db, "Data": data[:limit], "DataOmitted": len(data) - limit}
+
+def render_result_chunks(result, budget=SEARCH_MESSAGE_BUDGET, max_chunks=SEARCH_MAX_MESSAGES):
+    """Split the rendered result into message-sized chunks.
+
+    Returns (chunks, overflowed). Pieces are serialized lazily, so once
+    max_chunks messages are full and more is still pending, rendering stops
+    there and the rest of the response is never stringified.
+    """
+    chunks = []
+    buf = ""
+    for piece in _result_pieces(result):
+        while piece:
+            sep = "\n" if buf else ""
+            room = budget - len(buf) - len(sep)
+            if len(piece) <= room:
+                buf += sep + piece
+                break
+            # Split the piece only if it can't fit a message of its own.
+            if (not buf or len(piece) > budget) and room > 0:
+                buf += sep + piece[:room]
+                piece = piece[room:]
+            chunks.append(buf)
+            buf = ""
+            if len(chunks) == max_chunks:
+                return chunks, True
+    if buf:
+        chunks.append(buf)
+    return chunks, False
+
 # --- Handlers ---
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg_user = update.effective_user
     args = context.args or []
-    ensure_user(tg_user)
-
-    # referral handling (best-effort)
-    if args:
-        ref = args[0].strip()
-        refrow = get_user_by_refcode(ref)
-        if refrow:
-            ref_tg_id = refrow[0]
-            if ref_tg_id != tg_user.id:
-                conn = get_conn()
-                cur = conn.cursor()
-                cur.execute("SELECT referred_by FROM users WHERE telegram_id=?", (tg_user.id,))
-                r = cur.fetchone()
-                if r and (r[0] is None):
-                    cur.execute("UPDATE users SET referred_by=? WHERE telegram_id=?", (ref_tg_id, tg_user.id))
-                    conn.commit()
-                    conn.close()
-                    award_coins(ref_tg_id, REFERRAL_REWARD, kind="referral", note=f"referred {tg_user.id}")
-                    award_coins(tg_user.id, REFERRAL_REWARD, kind="referral", note=f"referred_by {ref_tg_id}")
-                else:
-                    conn.close()
+    await onboard_user(tg_user, args[0].strip() if args else None)
 
     txt = (
         "🔎 LeakOSINT Scanner Bot\n"
@@ -242,13 +746,14 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def referral_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg = update.effective_user
-    row = get_user_by_tg(tg.id)
+    row = await get_user_by_tg(tg.id)
     if not row:
         await update.message.reply_text("User not found. Send /start first.")
         return
-    refcode = row[2]
-    bot_username = (await context.bot.get_me()).username
-    start_link = f"https://t.me/{bot_username}?start={refcode}"
+    refcode = row["referral_code"]
+    # Application.initialize() already called getMe and caches the result on
+    # the bot, so this is a local attribute read, not an API round trip.
+    start_link = f"https://t.me/{context.bot.username}?start={refcode}"
     await update.message.reply_text(
         f"Your referral code: `{refcode}`\nInvite link: {start_link}\nBoth you and the new user get {REFERRAL_REWARD} coin(s) when they use this link.",
         parse_mode=constants.ParseMode.MARKDOWN,
@@ -256,7 +761,7 @@ async def referral_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg = update.effective_user
-    bal = get_balance(tg.id)
+    bal = await get_balance(tg.id)
     await update.message.reply_text(f"Your balance: {bal} coin(s).")
 
 async def deposit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -273,59 +778,170 @@ async def deposit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(text, parse_mode=constants.ParseMode.MARKDOWN)
 
-async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def command_payload(update: Update) -> str:
+    """Everything after the command word, taken straight from the message text
+    rather than re-joining the already tokenised context.args."""
+    parts = (update.message.text or "").split(None, 1)
+    return parts[1].strip() if len(parts) > 1 else ""
+
+# Last accepted /search per user (monotonic seconds). Entries older than the
+# interval are meaningless, so they're pruned whenever the dict grows large.
+_LAST_SEARCH: dict[int, float] = {}
+
+def _search_too_soon(tg_id) -> bool:
+    now = time.monotonic()
+    if now - _LAST_SEARCH.get(tg_id, float("-inf")) < SEARCH_MIN_INTERVAL:
+        return True
+    if len(_LAST_SEARCH) >= 10_000:
+        for uid in [u for u, t in _LAST_SEARCH.items() if now - t >= SEARCH_MIN_INTERVAL]:
+            del _LAST_SEARCH[uid]
+    _LAST_SEARCH[tg_id] = now
+    return False
+
+async def _do_search(update: Update, query_text: str):
     tg = update.effective_user
-    query_text = " ".join(context.args or [])
-    if not query_text:
-        await update.message.reply_text("Usage: /search <query>")
-        return
     if tg.id not in ADMIN_IDS:
-        ok, reason = deduct_coins(tg.id, COIN_COST_PER_SEARCH)
+        # Checked before charging, so a throttled search costs nothing.
+        if _search_too_soon(tg.id):
+            await update.message.reply_text(
+                f"Please wait {SEARCH_MIN_INTERVAL:g}s between searches.")
+            return
+        ok, reason = await deduct_coins(tg.id, COIN_COST_PER_SEARCH)
         if not ok:
+            # Nothing was charged, so don't make a retry after /deposit wait.
+            _LAST_SEARCH.pop(tg.id, None)
             await update.message.reply_text("Insufficient coins. Use /deposit to top up.")
             return
-    await update.message.reply_text(f"Scanning for: `{query_text}` …", parse_mode=constants.ParseMode.MARKDOWN)
-    result = query_leakosint(query_text)
-    out = json.dumps(result, indent=2)
-    if len(out) > 3800:
-        out = out[:3800] + "\n\n[truncated]"
-    await update.message.reply_text(f"```\n{out}\n```", parse_mode=constants.ParseMode.MARKDOWN)
+    # Search output is sent as plain text: the query and the leaked records are
+    # arbitrary user/third-party data, and one stray backtick or underscore
+    # would make Telegram reject a Markdown message outright.
+    await update.message.reply_text(f"Scanning for: {query_text} …")
+    result = await cached_query_leakosint(query_text)
+    # A result that doesn't fit SEARCH_MAX_MESSAGES goes out whole as a file.
+    chunks, overflowed = render_result_chunks(result)
+    if overflowed:
+        await update.message.reply_document(
+            document=orjson.dumps(result, option=orjson.OPT_INDENT_2),
+            filename="result.json",
+            caption="Result too long for chat; full response attached.",
+        )
+        return
+    for chunk in chunks:
+        await update.message.reply_text(chunk)
+
+async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query_text = command_payload(update)
+    if not query_text:
+        await update.message.reply_text("Usage: /search <query>")
+        return
+    await _do_search(update, query_text)
 
 async def search_number_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = " ".join(context.args or [])
+    q = command_payload(update)
     if not q:
         await update.message.reply_text("Usage: /search_number <number>")
         return
-    await search_cmd(update, context)
+    await _do_search(update, q)
 
 def is_admin(tg_id):
     return tg_id in ADMIN_IDS
 
+USERS_PAGE_SIZE = 50
+USERS_PAGE_BUDGET = 3800
+
+async def _users_page(before=None):
+    """Render one /users page that fits a message, plus a Next button when
+    more rows follow. Lines are added only while they fit the budget, and
+    the cursor is the last row actually shown, so nothing is skipped."""
+    # One row past the page tells us whether a next page exists.
+    rows = await list_users(limit=USERS_PAGE_SIZE + 1, before=before)
+    parts = ["Users:"]
+    size = len(parts[0])
+    last = None
+    shown = 0
+    for r in rows[:USERS_PAGE_SIZE]:
+        line = f"{r['telegram_id']} | @{r['username']} | coins={r['coins']} | ref={r['referral_code']}"
+        if size + 1 + len(line) > USERS_PAGE_BUDGET:
+            break
+        parts.append(line)
+        size += 1 + len(line)
+        last = r
+        shown += 1
+    markup = None
+    if last is not None and shown < len(rows):
+        cursor = f"users|{last['id']}|{last['created_at']}"
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("Next »", callback_data=cursor)]])
+    return "\n".join(parts), markup
+
 async def users_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return await update.message.reply_text("Unauthorized.")
-    rows = list_users(limit=200)
-    lines = [f"{r[0]} | @{r[1]} | coins={r[4]} | ref={r[2]}" for r in rows]
-    text = "Users:\n" + "\n".join(lines[:1000])
-    if len(text) > 3800:
-        text = text[:3800] + "\n\n[truncated]"
-    await update.message.reply_text(text)
+    text, markup = await _users_page()
+    await update.message.reply_text(text, reply_markup=markup)
+
+async def users_page_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        return await query.answer("Unauthorized.")
+    _, row_id, created_at = query.data.split("|", 2)
+    text, markup = await _users_page(before=(created_at, int(row_id)))
+    await query.answer()
+    try:
+        await query.edit_message_text(text, reply_markup=markup)
+    except BadRequest as e:
+        # A stale/double-pressed button re-renders the page already shown.
+        if "message is not modified" not in str(e).lower():
+            raise
 
 async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return await update.message.reply_text("Unauthorized.")
-    msg = " ".join(context.args or [])
+    msg = command_payload(update)
     if not msg:
         return await update.message.reply_text("Usage: /broadcast <message>")
-    rows = list_users(limit=10000)
+    # A broadcast to every user takes minutes at Telegram's rate limit, so it
+    # runs as a background task and the handler returns straight away.
+    context.application.create_task(_run_broadcast(update, context, msg), update=update)
+    await update.message.reply_text("Broadcast started; you'll get a summary when it finishes.")
+
+async def _run_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, msg: str):
+    # Sends overlap instead of running one round trip at a time; the semaphore
+    # bounds in-flight requests and the limiter keeps us under Telegram's rate.
+    # Recipients are pulled from the DB only as send slots free up, so sending
+    # starts with the first page and memory stays flat however many users exist.
+    sem = asyncio.Semaphore(BROADCAST_RATE_PER_SEC)
+    bucket = AsyncLimiter(BROADCAST_RATE_PER_SEC, 1)
+    pending = set()
     sent = 0
-    for r in rows:
-        tg_id = r[0]
+
+    async def send_one(tg_id):
+        nonlocal sent
         try:
-            await context.bot.send_message(chat_id=tg_id, text=msg)
-            sent += 1
+            for attempt in range(BROADCAST_MAX_RETRIES + 1):
+                try:
+                    async with bucket:
+                        await context.bot.send_message(chat_id=tg_id, text=msg)
+                except RetryAfter as e:
+                    # Flood control: wait at least as long as Telegram asks,
+                    # backing off further on each repeat for the same user.
+                    if attempt == BROADCAST_MAX_RETRIES:
+                        raise
+                    await asyncio.sleep(max(float(e.retry_after), 2 ** attempt))
+                else:
+                    sent += 1
+                    return
         except Exception:
-            continue
+            pass
+        finally:
+            sem.release()
+
+    async for tg_id in iter_user_ids():
+        await sem.acquire()
+        task = asyncio.create_task(send_one(tg_id))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.wait(pending)
     await update.message.reply_text(f"Broadcast sent to {sent} users.")
 
 async def addcoin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -339,12 +955,14 @@ async def addcoin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         amount = int(args[1])
     except ValueError:
         return await update.message.reply_text("Amount must be an integer.")
-    row = get_user_by_identifier(ident)
+    row = await get_user_by_identifier(ident)
     if not row:
         return await update.message.reply_text("User not found.")
-    tg_id = row[0]
-    award_coins(tg_id, amount, kind="admin_adjust", note=f"added_by {update.effective_user.id}")
-    await update.message.reply_text(f"Added {amount} coins to {tg_id}.")
+    tg_id = row["telegram_id"]
+    balance = await award_coins(tg_id, amount, kind="admin_adjust", note=f"added_by {update.effective_user.id}")
+    if balance is None:
+        return await update.message.reply_text("User not found.")
+    await update.message.reply_text(f"Added {amount} coins to {tg_id}. New balance: {balance}.")
 
 async def setcoins_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
@@ -357,50 +975,86 @@ async def setcoins_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         amount = int(args[1])
     except ValueError:
         return await update.message.reply_text("Amount must be an integer.")
-    row = get_user_by_identifier(ident)
+    row = await get_user_by_identifier(ident)
     if not row:
         return await update.message.reply_text("User not found.")
-    tg_id = row[0]
-    set_coins(tg_id, amount)
-    await update.message.reply_text(f"Set {tg_id} coins to {amount}.")
+    tg_id = row["telegram_id"]
+    balance = await set_coins(tg_id, amount)
+    if balance is None:
+        return await update.message.reply_text("User not found.")
+    await update.message.reply_text(f"Set {tg_id} coins to {balance}.")
 
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return await update.message.reply_text("Unauthorized.")
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM users")
-    users = cur.fetchone()[0]
-    cur.execute("SELECT SUM(coins) FROM users")
-    total_coins = cur.fetchone()[0] or 0
-    conn.close()
+    users, total_coins = await _fetchone(SQL_GET_STATS)
     await update.message.reply_text(f"Users: {users}\nTotal coins outstanding: {total_coins}")
 
 # --- Build application and add handlers ---
-application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+async def post_init(app):
+    await init_db()
+    start_writer()
+
+async def post_shutdown(app):
+    await stop_writer()
+    await close_db()
+    await _HTTP.aclose()
+    _RESP_CACHE.close()
+
+application = (
+    ApplicationBuilder()
+    .token(TELEGRAM_BOT_TOKEN)
+    # Handlers run concurrently (a slow /search no longer holds up everyone
+    # else), so give the outbound Bot API client enough pooled connections
+    # that they don't queue behind each other for a free slot.
+    .concurrent_updates(256)
+    .connection_pool_size(256)
+    .pool_timeout(30)
+    .post_init(post_init)
+    .post_shutdown(post_shutdown)
+    .build()
+)
 
 # register handlers
-application.add_handler(CommandHandler("start", start_cmd))
-application.add_handler(CommandHandler("referral", referral_cmd))
-application.add_handler(CommandHandler("balance", balance_cmd))
-application.add_handler(CommandHandler("deposit", deposit_cmd))
-application.add_handler(CommandHandler("search", search_cmd))
-application.add_handler(CommandHandler("search_number", search_number_cmd))
-
-application.add_handler(CommandHandler("users", users_cmd))
-application.add_handler(CommandHandler("broadcast", broadcast_cmd))
-application.add_handler(CommandHandler("addcoin", addcoin_cmd))
-application.add_handler(CommandHandler("setcoins", setcoins_cmd))
-application.add_handler(CommandHandler("stats", stats_cmd))
+COMMANDS = {
+    "start": start_cmd,
+    "referral": referral_cmd,
+    "balance": balance_cmd,
+    "deposit": deposit_cmd,
+    "search": search_cmd,
+    "search_number": search_number_cmd,
+
+    "users": users_cmd,
+    "broadcast": broadcast_cmd,
+    "addcoin": addcoin_cmd,
+    "setcoins": setcoins_cmd,
+    "stats": stats_cmd,
+}
+
+async def dispatch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Route every /command through one dict lookup rather than having PTB test
+    a CommandHandler per command. Fills context.args the way CommandHandler
+    does and ignores commands addressed to another bot (/cmd@otherbot)."""
+    text = update.message.text
+    head = text.split(None, 1)[0]
+    command, _, target = head[1:].partition("@")
+    if target and target.lower() != context.bot.username.lower():
+        return
+    handler = COMMANDS.get(command.lower())
+    if handler is None:
+        return
+    context.args = text.split()[1:]
+    await handler(update, context)
+
+application.add_handler(MessageHandler(filters.COMMAND, dispatch_command))
+application.add_handler(CallbackQueryHandler(users_page_cb, pattern=r"^users\|"))
 
 # --- Main / Run webhook server ---
 def main():
-    init_db()
-
     # build webhook URL
     webhook_path = WEBHOOK_PATH if WEBHOOK_PATH.startswith("/") else f"/{WEBHOOK_PATH}"
     webhook_path = webhook_path.rstrip("/")  # remove trailing if any
-    webhook_path_only = webhook_path.lstrip("/")  # run_webhook wants path without leading slash in some versions
+    webhook_path_only = webhook_path.lstrip("/")  # run_webhook's url_path is relative to the server root
 
     if RENDER_EXTERNAL_URL:
         webhook_url = f"{RENDER_EXTERNAL_URL.rstrip('/')}{webhook_path}"
@@ -416,10 +1070,13 @@ def main():
         application.run_webhook(
             listen="0.0.0.0",
             port=PORT,
-            webhook_path=f"/{webhook_path_only}",
+            url_path=webhook_path_only,
             webhook_url=webhook_url,
             secret_token=TELEGRAM_WEBHOOK_SECRET_TOKEN,
-            max_connections=40,
+            # Let Telegram deliver up to its maximum 100 updates in parallel,
+            # and only the update types we have handlers for.
+            max_connections=100,
+            allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY],
         )
     except Exception:
         logger.exception("Failed to run webhook server")